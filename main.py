@@ -7,17 +7,37 @@ However, the script is far from perfect :)
 Author: Denis Romanov (https://github.com/isdrmv).
 """
 
-from typing import Dict
-import json
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Set, Tuple
+from urllib.parse import urlsplit
 import logging
 import os
+import shutil
+import socket
 import sys
+import threading
 
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
+import orjson
 import requests
 
 LOG_FILE = 'plugin_updater.log'
 VERSION_FILE = 'plugin_versions.json'
 PLUGIN_DIR = 'plugins'
+# The work is network-bound, so the threads mostly wait on sockets.
+MAX_WORKERS = 16
+# Seconds to wait for metadata, Jenkins builds JSON can be large and slow.
+METADATA_TIMEOUT = 60
+# (connect, read) seconds for jars, the read timeout applies to each chunk.
+DOWNLOAD_TIMEOUT = (10, 60)
+# Jars are much heavier than metadata, so fewer of them at a time.
+MAX_DOWNLOADS = 8
+# Jars are streamed to disk by chunks instead of being kept in memory.
+CHUNK_SIZE = 64 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
 
 # Spigot:
 # 'project_url': 'file_name_with_extension'
@@ -45,6 +65,18 @@ PLUGINS = {
     'https://dev.bukkit.org/projects/worldguard/files/latest': 'WorldGuard.jar',
 }
 # pylint: enable=line-too-long
+# Checked once here rather than for every plugin at runtime.
+assert all(
+    isinstance(url, str) and isinstance(files, (str, dict))
+    for url, files in PLUGINS.items()
+), 'PLUGINS must map URL strings to a file name or a dict of file names.'
+
+# (domain, plugin kind). A domain matches the host itself and all its
+# subdomains.
+HANDLERS = [
+    ('spigotmc.org', 'spigot'),
+    ('github.com', 'github'),
+]
 
 
 def run_logging() -> None:
@@ -58,36 +90,131 @@ def run_logging() -> None:
             logging.StreamHandler(),
         ]
     )
+    # httpx logs every request at the INFO level.
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+
+def describe_plugin(url: str, files: str | Dict[int, str]) -> Dict[str, Any]:
+    """Get the plugin kind and its API URLs, so they are built only once."""
+    host = urlsplit(url).hostname or ''
+    for domain, kind in HANDLERS:
+        if host == domain or host.endswith(f'.{domain}'):
+            break
+    else:
+        # Unfortunately, plugin developers usually host Jenkins on their
+        # own server. Fortunately, such domains always have a
+        # "ci" subdomain. The other types of plugins try to download from
+        # direct links.
+        kind = 'jenkins' if host.startswith('ci.') else 'direct'
+
+    plugin = {'kind': kind, 'url': url, 'files': files}
+    if kind == 'spigot':
+        resource = url.split('.')[-1]
+        api = f'https://api.spiget.org/v2/resources/{resource}'
+        plugin['api'] = f'{api}/versions/latest'
+        plugin['download'] = f'{api}/download?version='
+    elif kind == 'jenkins':
+        plugin['api'] = f'{url}/lastSuccessfulBuild/api/json'
+        plugin['artifact'] = f'{url}/lastSuccessfulBuild/artifact/'
+    elif kind == 'github':
+        plugin['api'] = (f'{url.replace("github.com", "api.github.com/repos")}'
+                         f'/releases/latest')
+    return plugin
+
+
+SOURCES: List[Dict[str, Any]] = [
+    describe_plugin(url, files) for url, files in PLUGINS.items()
+]
 
 
 class VersionFileHandler:
     """Working with a JSON file containing plugin versions."""
 
     def __init__(self):
-        self._data: Dict[str, int] = {}
+        # {file: {'version': int, 'etag': str, 'last_modified': str,
+        #         'file_etag': str}}
+        self._data: Dict[str, Dict[str, Any]] = {}
+        # Whether the data differs from the file contents.
+        self._dirty: bool = False
 
         self._handle_file()
 
-    def __del__(self):
+    def __enter__(self) -> 'VersionFileHandler':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Write the data to the file if it has been changed."""
         self.write()
 
     def get(self, key: str) -> int | None:
-        """Get a value from the data by key."""
-        return self._data[key] if key in self._data else None
+        """Get a version from the data by key."""
+        return self._data.get(key, {}).get('version')
 
     def set(self, key: str, value: int) -> None:
-        """Set a value on the key in the data."""
-        self._data[key] = value
+        """Set a version on the key in the data."""
+        self._update(key, version=value)
+
+    def get_validators(self, key: str) -> Dict[str, str]:
+        """Get conditional request headers for the key."""
+        entry = self._data.get(key, {})
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def set_validators(self, key: str, headers: Mapping[str, str]) -> None:
+        """Remember ETag and Last-Modified of the response for the key."""
+        self._update(
+            key,
+            etag=headers.get('ETag'),
+            last_modified=headers.get('Last-Modified'),
+        )
+
+    def get_file_etag(self, key: str) -> str | None:
+        """Get ETag of the downloaded file by key."""
+        return self._data.get(key, {}).get('file_etag')
+
+    def set_file_etag(self, key: str, etag: str | None) -> None:
+        """Remember ETag of the downloaded file for the key."""
+        self._update(key, file_etag=etag)
 
     def read(self) -> None:
         """Read a data from the file."""
-        with open(VERSION_FILE, 'r') as infile:
-            self._data = json.load(infile)
+        with open(VERSION_FILE, 'rb') as infile:
+            self._data = orjson.loads(infile.read())
+        # Older files store a bare version number per file.
+        for key, value in self._data.items():
+            if isinstance(value, int):
+                self._data[key] = {'version': value}
+                self._dirty = True
 
     def write(self) -> None:
-        """Write the current data to the file."""
-        with open(VERSION_FILE, 'w+') as outfile:
-            json.dump(self._data, outfile)
+        """Write the current data to the file if it has been changed."""
+        if not self._dirty:
+            return
+
+        with open(VERSION_FILE, 'wb') as outfile:
+            outfile.write(orjson.dumps(self._data))
+        self._dirty = False
+
+    def _update(self, key: str, **fields: Any) -> None:
+        """Update fields of the entry, marking the data dirty on change."""
+        # Do not leave empty entries, e.g. for a server sending no ETag.
+        if key not in self._data and all(
+            value is None for value in fields.values()
+        ):
+            return
+
+        entry = self._data.setdefault(key, {})
+        for field, value in fields.items():
+            if entry.get(field) != value:
+                entry[field] = value
+                self._dirty = True
 
     def _handle_file(self) -> None:
         """Create/read the file depending on its existence."""
@@ -95,22 +222,56 @@ class VersionFileHandler:
         if os.path.exists(VERSION_FILE):
             self.read()
         else:
+            self._dirty = True
             self.write()
 
 
 class PluginUpdater:
     """Downloading/updating plugins if its version is outdated."""
 
-    def __init__(self):
+    def __init__(self, version_file_handler: VersionFileHandler):
         # A little statistics to broaden the mind.
         self._updated: int = 0
         self._downloaded: int = 0
         self._total: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        # New versions (and metadata validators) of the files, stored to the
+        # version file only once all files of the plugin are downloaded.
+        # {file: (version, headers, all files of the plugin)}
+        self._pending: Dict[
+            str, Tuple[int, Mapping[str, str], Tuple[str, ...]]
+        ] = {}
+        self._finished: Set[str] = set()
+
+        self._version_file_handler: VersionFileHandler = version_file_handler
+        self._session: requests.Session = self._create_session()
+        # Metadata responses are tiny and dominated by round-trips, so they
+        # are multiplexed over a single HTTP/2 connection per host.
+        self._metadata_client: httpx.Client = httpx.Client(
+            timeout=METADATA_TIMEOUT,
+            transport=httpx.HTTPTransport(
+                http2=True,
+                retries=3,
+                limits=httpx.Limits(max_keepalive_connections=8),
+                socket_options=[
+                    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                ],
+            ),
+        )
 
-        self._version_file_handler: VersionFileHandler = VersionFileHandler()
+        self._handlers = {
+            'spigot': self._handle_spigot,
+            'jenkins': self._handle_jenkins,
+            'github': self._handle_github,
+            'direct': self._handle_direct,
+        }
 
         self._handle_dirs()
 
+    def __del__(self):
+        self._session.close()
+        self._metadata_client.close()
+
     def run(self) -> None:
         """Run PluginUpdater."""
         logging.info('PluginUpdater is running.')
@@ -119,26 +280,25 @@ class PluginUpdater:
             logging.critical('Plugins are not specified.')
             return
 
-        for url, files in PLUGINS.items():
-            if type(url) != str or type(files) not in (str, dict):
-                return
+        self._total = sum(
+            len(files) if isinstance(files, dict) else 1
+            for files in PLUGINS.values()
+        )
 
-            self._total += len(files) if type(files) == dict else 1
-
-            domain = url.lower().split('/')[2]
-            if 'spigotmc.org' in domain:
-                self.download(self._handle_spigot(url, files))
-            # Unfortunately, plugin developers usually host Jenkins on their
-            # own server. Fortunately, such domains always have a
-            # "ci" subdomain.
-            elif 'ci.' in domain:
-                self.download(self._handle_jenkins(url, files))
-            elif 'github.com' in domain:
-                self.download(self._handle_github(url, files))
-            else:
-                # The other types of plugins try to download from
-                # direct links.
-                self.download({url: files})
+        # Every plugin lives on its own host, so requests to them can
+        # overlap instead of waiting for each other.
+        data = {}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            try:
+                for result in executor.map(self._resolve, SOURCES):
+                    if result is not None:
+                        data.update(result)
+            except BaseException:
+                # Do not start the queued work after an interrupt.
+                executor.shutdown(cancel_futures=True)
+                raise
+
+        self.download(data)
 
         logging.info(
             f'PluginUpdater is finished (updated/downloaded/total: '
@@ -146,94 +306,288 @@ class PluginUpdater:
         )
 
     def download(self, data: Dict[str, str] | None) -> None:
-        """Download the plugin by data."""
-        if data is None:
+        """Download the plugins by data."""
+        if not data:
             return
 
-        for url, file in data.items():
-            response = requests.get(url)
-            if response.ok:
-                with open(f'{PLUGIN_DIR}/{file}', 'wb') as outfile:
-                    outfile.write(response.content)
-                    self._downloaded += 1
-            else:
-                logging.error(f'Failed to download the file "{file}".')
+        # A slow CDN should not hold back the other files.
+        with ThreadPoolExecutor(max_workers=MAX_DOWNLOADS) as executor:
+            try:
+                self._downloaded += sum(
+                    executor.map(self._fetch_one, data.keys(), data.values())
+                )
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+
+    def _fetch_one(self, url: str, file: str) -> bool:
+        """Download the single file, return True on success."""
+        try:
+            return self._download_file(url, file)
+        except (requests.RequestException, OSError) as exc:
+            logging.error(f'Failed to download the file "{file}": {exc}')
+            return False
+
+    def _download_file(self, url: str, file: str) -> bool:
+        """Download the file if it differs from the one on disk."""
+        if self._is_downloaded(url, file):
+            logging.info(f'The file "{file}" is already up to date.')
+            self._commit(file)
+            return False
+
+        path = f'{PLUGIN_DIR}/{file}'
+        # The jar is replaced only when fully downloaded, so an interrupted
+        # download never leaves a broken plugin behind.
+        tmp = f'{path}.part'
+        try:
+            with self._session.get(
+                url, stream=True, timeout=DOWNLOAD_TIMEOUT
+            ) as response:
+                if not response.ok:
+                    logging.error(f'Failed to download the file "{file}".')
+                    return False
+
+                # Let urllib3 undo gzip/deflate, otherwise the compressed
+                # bytes would end up in the jar.
+                response.raw.decode_content = True
+                with open(tmp, 'wb', buffering=WRITE_BUFFER_SIZE) as outfile:
+                    shutil.copyfileobj(response.raw, outfile, CHUNK_SIZE)
+                    written = outfile.tell()
+
+                # Content-Length only describes the body as it was sent, so
+                # it can be compared with the written size for identity
+                # encoding.
+                length = response.headers.get('Content-Length')
+                if (length is not None
+                        and 'Content-Encoding' not in response.headers
+                        and int(length) != written):
+                    logging.error(
+                        f'The file "{file}" is truncated '
+                        f'({written} of {length} bytes).'
+                    )
+                    return False
+
+                os.replace(tmp, path)
+                self._version_file_handler.set_file_etag(
+                    file, response.headers.get('ETag')
+                )
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+        self._commit(file)
+        return True
+
+    def _add_pending(
+        self,
+        files: Tuple[str, ...],
+        version: int,
+        headers: Mapping[str, str],
+    ) -> None:
+        """Remember the new version of the plugin files to be downloaded."""
+        with self._lock:
+            for file in files:
+                self._pending[file] = (version, headers, files)
+            self._updated += len(files)
+
+    def _commit(self, file: str) -> None:
+        """Store the pending versions once all plugin files are downloaded.
+
+        The version check and the validators use the first file of the
+        plugin only, so storing it early would hide a failed other file.
+        """
+        if file not in self._pending:
+            return
+
+        with self._lock:
+            version, headers, files = self._pending[file]
+            self._finished.add(file)
+            if not self._finished.issuperset(files):
+                return
+
+            for name in files:
+                del self._pending[name]
+                self._version_file_handler.set(name, version)
+                self._version_file_handler.set_validators(name, headers)
+
+    def _is_downloaded(self, url: str, file: str) -> bool:
+        """Check whether the file on disk matches the remote one.
+
+        Only headers are requested, so an unchanged jar is not transferred.
+        """
+        path = f'{PLUGIN_DIR}/{file}'
+        if not os.path.exists(path):
+            return False
+
+        try:
+            response = self._session.head(
+                url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT
+            )
+        except requests.RequestException:
+            # Let the download itself try and report the problem.
+            return False
+        length = response.headers.get('Content-Length')
+        if (not response.ok
+                or length is None
+                or 'Content-Encoding' in response.headers
+                or int(length) != os.path.getsize(path)):
+            return False
+
+        etag = response.headers.get('ETag')
+        if etag is None:
+            # The size alone cannot tell that a new version reported by the
+            # metadata is the jar on disk, it is enough for direct URLs only.
+            return file not in self._pending
+        return etag == self._version_file_handler.get_file_etag(file)
+
+    def _resolve(self, plugin: Dict[str, Any]) -> Dict[str, str] | None:
+        """Get direct URLs to the plugin files that need downloading."""
+        # One failing host must not abort the other plugins or downloads.
+        try:
+            return self._handlers[plugin['kind']](plugin)
+        except Exception as exc:
+            logging.error(
+                f'Failed to get data from URL: "{plugin["url"]}" ({exc}).'
+            )
+            return None
+
+    def _create_session(self) -> requests.Session:
+        """Create a session reusing connections to the same hosts."""
+        adapter = HTTPAdapter(
+            pool_connections=MAX_WORKERS,
+            pool_maxsize=MAX_WORKERS,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.3,
+                status_forcelist=(500, 502, 503, 504),
+                # Return the last response instead of raising RetryError,
+                # so it is handled as any other failed response.
+                raise_on_status=False,
+            ),
+        )
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
 
     def _handle_dirs(self) -> None:
         """Create the plugins directory if it does not exist."""
         if not os.path.exists(PLUGIN_DIR):
             os.makedirs(PLUGIN_DIR, exist_ok=True)
 
-    def _handle_spigot(self, url: str, file: str) -> Dict[str, str] | None:
+    def _handle_direct(self, plugin: Dict[str, Any]) -> Dict[str, str]:
+        """Get a direct URL to the plugin, which is its URL itself."""
+        return {plugin['url']: plugin['files']}
+
+    def _get_metadata(
+        self, plugin: Dict[str, Any], key: str
+    ) -> httpx.Response | None:
+        """Get plugin metadata, conditionally if it was seen before.
+
+        The server answers 304 Not Modified with an empty body if nothing
+        has changed since the response the validators were taken from.
+        """
+        try:
+            return self._metadata_client.get(
+                plugin['api'],
+                headers=self._version_file_handler.get_validators(key),
+                follow_redirects=True,
+            )
+        except httpx.HTTPError:
+            logging.error(f'Failed to get data from URL: "{plugin["url"]}".')
+            return None
+
+    def _handle_spigot(
+        self, plugin: Dict[str, Any]
+    ) -> Dict[str, str] | None:
         """Get a direct URL to the Spigot plugin."""
-        resource = url.split('.')[-1]
-        response = requests.get(
-            f'https://api.spiget.org/v2/resources/{resource}/versions/latest'
-        )
-        if response.ok:
+        file = plugin['files']
+        # Spiget has no bulk lookup by resource IDs (/resources pages over
+        # the whole catalogue), so the latest version is requested per
+        # resource. These requests run concurrently over pooled
+        # connections to api.spiget.org, see run().
+        response = self._get_metadata(plugin, file)
+        if response is None or response.status_code == 304:
+            return None
+        if response.is_success:
             version = response.json()['id']
-            if self._version_file_handler.get(file) != version:
-                self._version_file_handler.set(file, version)
-                self._updated += 1
-                direct_url = (f'https://api.spiget.org/v2/resources/'
-                              f'{resource}/download?version={version}')
-                return {direct_url: file}
+            if self._version_file_handler.get(file) == version:
+                self._version_file_handler.set_validators(
+                    file, response.headers
+                )
+            else:
+                self._add_pending((file,), version, response.headers)
+                return {f'{plugin["download"]}{version}': file}
         else:
-            logging.error(f'Failed to get data from URL: "{url}".')
+            logging.error(f'Failed to get data from URL: "{plugin["url"]}".')
 
     def _handle_jenkins(
-        self, url: str, files: Dict[int, str]
+        self, plugin: Dict[str, Any]
     ) -> Dict[str, str] | None:
         """Get a direct URL to the Jenkins plugin."""
-        response = requests.get(f'{url}/lastSuccessfulBuild/api/json')
-        if response.ok:
+        files = plugin['files']
+        key = files[next(iter(files))]
+        response = self._get_metadata(plugin, key)
+        if response is None or response.status_code == 304:
+            return None
+        if response.is_success:
             data = response.json()
             build = data['number']
-            if self._version_file_handler.get(
-                files[next(iter(files))]
-            ) != build:
+            if self._version_file_handler.get(key) == build:
+                self._version_file_handler.set_validators(
+                    key, response.headers
+                )
+            else:
                 result = {}
                 for i, file in files.items():
-                    direct_url = (f'{url}/lastSuccessfulBuild/artifact/'
+                    direct_url = (f'{plugin["artifact"]}'
                                   f'{data["artifacts"][i]["relativePath"]}')
                     result[direct_url] = file
-                    self._version_file_handler.set(file, build)
-                    self._updated += 1
+                self._add_pending(
+                    tuple(files.values()), build, response.headers
+                )
                 return result
         else:
-            logging.error(f'Failed to get data from URL: "{url}".')
+            logging.error(f'Failed to get data from URL: "{plugin["url"]}".')
 
     def _handle_github(
-        self, url: str, files: Dict[int, str]
+        self, plugin: Dict[str, Any]
     ) -> Dict[str, str] | None:
         """Get a direct URL to the GitHub plugin."""
-        response = requests.get(
-            f'{url.replace("github.com", "api.github.com/repos")}/'
-            f'releases/latest'
-        )
-        if response.ok:
+        files = plugin['files']
+        key = files[next(iter(files))]
+        response = self._get_metadata(plugin, key)
+        if response is None or response.status_code == 304:
+            return None
+        if response.is_success:
             data = response.json()
             release = data['id']
-            if self._version_file_handler.get(
-                files[next(iter(files))]
-            ) != release:
+            if self._version_file_handler.get(key) == release:
+                self._version_file_handler.set_validators(
+                    key, response.headers
+                )
+            else:
                 result = {}
                 for i, file in files.items():
                     direct_url = data['assets'][i]['browser_download_url']
                     result[direct_url] = file
-                    self._version_file_handler.set(file, release)
-                    self._updated += 1
+                self._add_pending(
+                    tuple(files.values()), release, response.headers
+                )
                 return result
         else:
-            logging.error(f'Failed to get data from URL: "{url}".')
+            logging.error(f'Failed to get data from URL: "{plugin["url"]}".')
 
 
 def main() -> None:
     """Run logging and PluginUpdater."""
     run_logging()
 
-    plugin_updater = PluginUpdater()
-    plugin_updater.run()
+    # The versions are written on leaving the block, even on errors and
+    # interrupts, and only if something has been changed.
+    with VersionFileHandler() as version_file_handler:
+        plugin_updater = PluginUpdater(version_file_handler)
+        plugin_updater.run()
 
 
 if __name__ == '__main__':